@@ -3,39 +3,77 @@
 """
 db.py  – thin, read/write wrapper around **art.sqlite**
 
-Four tables (all created automatically):
+Seven tables (all created automatically):
 
     embeddings         filename PK → never mutated after initial ingest
+    embedding_shard    filename PK → row in the current shard file
+    shard_file         single row  → name of that shard file
     artists            artist   PK → aux-info for the viewer side-panel
     configs            every DR run (OVERWRITE by config_id possible)
-    projection_points  1 row per projected 2-D point
+    point_coords       config_id PK → all projected points as column BLOBs
+    projection_points  legacy: 1 row per point, read for older configs
 
-All functions open their own connection via the `conn()` context–manager.
-Foreign-keys are ON; a cascade delete on configs will automatically
-purge its projection_points.
+The embedding BLOBs are copied once into a contiguous float32 `.npy`
+file next to EMB_PATH that is memory-mapped on first use; subsets are
+read by row index from there instead of decoding BLOBs per query.  Each
+rebuild writes a new file and switches shard_file and embedding_shard
+in one commit, so a reader always pairs a file with its own row map.
+
+All functions share one module-level connection via the `conn()`
+context–manager, which serialises access within the process and wraps
+every block in an explicit BEGIN/COMMIT; `conn(write=True)` opens with
+BEGIN IMMEDIATE so writers queue on SQLite's write lock across
+processes.  Foreign-keys are ON; a cascade delete on configs will
+automatically purge its points.  The database runs in WAL mode with
+synchronous=NORMAL.
 """
 from __future__ import annotations
-import json, sqlite3, os
+import atexit, json, random, sqlite3, os, tempfile, threading
 from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Iterable
+from typing import Any, Sequence
 
 # ---------- location ----------
 DB_PATH = Path(os.getenv("DR_DB", "art.sqlite")).expanduser()
+EMB_PATH = Path(os.getenv("DR_EMB", DB_PATH.with_suffix(".emb.npy"))).expanduser()
 
 # ---------------------------------------------------------------------
 # 0)  connection helper
 # ---------------------------------------------------------------------
+_PRAGMAS = (
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA journal_mode = WAL",       # readers never block the writer
+    "PRAGMA synchronous = NORMAL",     # fsync on checkpoint, not per commit
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -20000",      # ~20 MB page cache
+    "PRAGMA busy_timeout = 30000",     # wait for concurrent dr.py runs
+)
+
+# opened once per process; isolation_level=None → no implicit BEGINs,
+# a larger statement cache keeps the prepared SQL below hot
+_CONN = sqlite3.connect(DB_PATH, isolation_level=None,
+                        check_same_thread=False, cached_statements=256)
+_CONN.row_factory = sqlite3.Row        # results behave like dicts
+for _pragma in _PRAGMAS:
+    _CONN.execute(_pragma)
+atexit.register(_CONN.close)
+_LOCK = threading.Lock()
+
 @contextmanager
-def conn():
-    con = sqlite3.connect(DB_PATH)
-    con.row_factory = sqlite3.Row      # results behave like dicts
-    con.execute("PRAGMA foreign_keys = ON")
-    try:
-        yield con
-        con.commit()
-    finally:
-        con.close()
+def conn(write: bool = False):
+    # writers take the write lock up front (BEGIN IMMEDIATE): a deferred
+    # BEGIN that reads and then writes fails with SQLITE_BUSY instead of
+    # waiting when another process committed in between
+    with _LOCK:
+        _CONN.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            yield _CONN
+            if _CONN.in_transaction:   # executescript() may have committed
+                _CONN.execute("COMMIT")
+        except BaseException:
+            if _CONN.in_transaction:
+                _CONN.execute("ROLLBACK")
+            raise
 
 # ---------------------------------------------------------------------
 # 1)  schema bootstrap (run on import)
@@ -47,6 +85,22 @@ CREATE TABLE IF NOT EXISTS embeddings (
   artist     TEXT NOT NULL,
   embedding  BLOB NOT NULL
 );
+-- covers the per-artist top-k lookups in fetch_subset
+CREATE INDEX IF NOT EXISTS idx_embeddings_artist_filename
+    ON embeddings(artist, filename);
+
+-- row of each embedding in the memory-mapped shard file
+CREATE TABLE IF NOT EXISTS embedding_shard (
+  filename   TEXT PRIMARY KEY,
+  row        INTEGER NOT NULL,
+
+  FOREIGN KEY(filename) REFERENCES embeddings(filename) ON DELETE CASCADE
+);
+-- the shard file (in EMB_PATH's directory) embedding_shard indexes into
+CREATE TABLE IF NOT EXISTS shard_file (
+  id    INTEGER PRIMARY KEY CHECK (id = 0),
+  name  TEXT NOT NULL
+);
 
 -- auxiliary lookup
 CREATE TABLE IF NOT EXISTS artists (
@@ -64,10 +118,23 @@ CREATE TABLE IF NOT EXISTS configs (
   subset_size     INTEGER,
   params_json     TEXT NOT NULL,
   runtime         REAL,
-  created_at      TEXT DEFAULT (datetime('now'))
+  created_at      TEXT DEFAULT (datetime('now')),
+  cache_key       TEXT            -- hash of (method, params, subset)
 );
 
--- projected 2-D points, <= 500 per config
+-- projected 2-D points of one config, structure-of-arrays:
+--   xy         float32 little-endian, N × (x, y) interleaved
+--   filenames  / artists: UTF-8, newline-joined, same order as xy
+CREATE TABLE IF NOT EXISTS point_coords (
+  config_id  INTEGER PRIMARY KEY,
+  xy         BLOB NOT NULL,
+  filenames  BLOB NOT NULL,
+  artists    BLOB NOT NULL,
+
+  FOREIGN KEY(config_id) REFERENCES configs(config_id) ON DELETE CASCADE
+);
+
+-- legacy per-point rows (configs saved before point_coords); read-only
 CREATE TABLE IF NOT EXISTS projection_points (
   id         INTEGER PRIMARY KEY,
   filename   TEXT NOT NULL,
@@ -82,101 +149,362 @@ CREATE TABLE IF NOT EXISTS projection_points (
 """
 
 with conn() as c:
+    # executescript() commits first and runs each statement on its own;
+    # every CREATE … IF NOT EXISTS is safe to race
     c.executescript(_SCHEMA_SQL)
 
+# the migration checks then alters, so it needs the write lock throughout
+with conn(write=True) as c:
+    # databases created before configs.cache_key existed
+    if "cache_key" not in {r["name"] for r in c.execute("PRAGMA table_info(configs)")}:
+        c.execute("ALTER TABLE configs ADD COLUMN cache_key TEXT")
+    c.execute("""CREATE UNIQUE INDEX IF NOT EXISTS idx_configs_cache_key
+                     ON configs(cache_key)""")
+
+# ---------------------------------------------------------------------
+# 2)  statements (module constants → sqlite3 statement cache hits)
+# ---------------------------------------------------------------------
+# strategy queries select metadata only (shard rows are looked up after)
+# artist_first5: the recursive CTE skip-scans idx_embeddings_artist_filename
+# (one seek per distinct artist), then each artist's first 5 filenames are
+# seeks on the same index; only those ≤ #artists × 5 rows get sorted
+_SQL_ARTIST_FIRST5 = """
+  WITH RECURSIVE a(artist) AS (
+    SELECT min(artist) FROM embeddings
+    UNION ALL
+    SELECT (SELECT min(artist) FROM embeddings WHERE artist > a.artist)
+      FROM a WHERE a.artist IS NOT NULL
+  )
+  SELECT e.filename, e.artist
+    FROM a
+    CROSS JOIN embeddings e
+      ON e.artist = a.artist
+     AND e.filename IN (SELECT filename FROM embeddings
+                         WHERE artist = a.artist
+                         ORDER BY filename LIMIT 5)
+   ORDER BY e.artist, e.filename
+   LIMIT ?;
+"""
+# random: rowids (served from the filename index) are sampled in Python
+# with a seedable RNG, then the k picked rows are fetched by PK
+_SQL_ROWIDS       = "SELECT rowid FROM embeddings"
+_SQL_ROWS_BY_ID   = "SELECT filename, artist FROM embeddings WHERE rowid IN ({})"
+
+_SQL_COUNT_EMBEDDINGS = "SELECT count(*) FROM embeddings"
+_SQL_COUNT_SHARD      = "SELECT count(*) FROM embedding_shard"
+# any embedding without a shard row (e.g. inserted by an external writer)
+_SQL_UNSHARDED        = """
+  SELECT 1 FROM embeddings e
+   WHERE NOT EXISTS (SELECT 1 FROM embedding_shard s WHERE s.filename = e.filename)
+   LIMIT 1
+"""
+_SQL_SCAN_EMBEDDINGS  = "SELECT filename, embedding FROM embeddings ORDER BY rowid"
+_SQL_INSERT_SHARD     = "INSERT INTO embedding_shard(filename, row) VALUES (?,?)"
+_SQL_SHARD_ROWS       = "SELECT filename, row FROM embedding_shard WHERE filename IN ({})"
+_SQL_SHARD_FILE       = "SELECT name FROM shard_file WHERE id = 0"
+_SQL_SET_SHARD_FILE   = "REPLACE INTO shard_file(id, name) VALUES (0, ?)"
+
+_SQL_INSERT_CONFIG = """
+  INSERT INTO configs
+         (method, subset_strategy, subset_size, params_json, runtime,
+          cache_key)
+  VALUES (?,?,?,?,?,?)
+"""
+_SQL_REPLACE_CONFIG = """
+  REPLACE INTO configs
+          (config_id, method, subset_strategy, subset_size,
+           params_json, runtime, cache_key)
+   VALUES (?,?,?,?,?,?,?)
+"""
+# only runs whose points were stored count as cached
+_SQL_FIND_CONFIG = """
+  SELECT config_id FROM configs c
+   WHERE cache_key = ?
+     AND EXISTS (SELECT 1 FROM point_coords p WHERE p.config_id = c.config_id)
+"""
+_SQL_RELEASE_CACHE_KEY = """
+  UPDATE configs SET cache_key = NULL
+   WHERE cache_key = ? AND config_id IS NOT ?
+"""
+_SQL_SAVE_COORDS = """
+  REPLACE INTO point_coords(config_id, xy, filenames, artists)
+        VALUES (?,?,?,?)
+"""
+_SQL_SELECT_COORDS = """
+  SELECT xy, filenames, artists FROM point_coords WHERE config_id = ?
+"""
+_SQL_SELECT_CONFIG = "SELECT * FROM configs WHERE config_id = ?"
+_SQL_SELECT_LEGACY_POINTS = """
+  SELECT filename, artist, x, y
+    FROM projection_points
+   WHERE config_id = ?
+   ORDER BY id
+"""
+
 # ---------------------------------------------------------------------
-# 2)  convenience helpers
+# 3)  embedding shard (one-time export of the BLOBs, then memory-mapped)
+# ---------------------------------------------------------------------
+_SHARD = None   # (file name, np.memmap (N, d) float32), opened lazily
+
+def _open_shard(c: sqlite3.Connection):
+    """Return the memmap of the shard file named in c's snapshot, or None."""
+    global _SHARD
+    import numpy as np
+
+    row = c.execute(_SQL_SHARD_FILE).fetchone()
+    if row is None:
+        return None
+    if _SHARD is None or _SHARD[0] != row["name"]:
+        try:
+            _SHARD = (row["name"],
+                      np.load(EMB_PATH.parent / row["name"], mmap_mode="r"))
+        except FileNotFoundError:   # superseded and removed by a newer build
+            return None
+    return _SHARD[1]
+
+
+def _shard_covers(c: sqlite3.Connection) -> bool:
+    """True if the current shard file holds exactly the rows of embeddings."""
+    return (c.execute(_SQL_SHARD_FILE).fetchone() is not None
+            and (c.execute(_SQL_COUNT_SHARD).fetchone()[0]
+                 == c.execute(_SQL_COUNT_EMBEDDINGS).fetchone()[0])
+            and c.execute(_SQL_UNSHARDED).fetchone() is None)
+
+
+def _build_shard(c: sqlite3.Connection) -> Path:
+    """Copy all embedding BLOBs into a new shard file and index them by row."""
+    import numpy as np
+
+    n = c.execute(_SQL_COUNT_EMBEDDINGS).fetchone()[0]
+    first = c.execute(_SQL_SCAN_EMBEDDINGS).fetchone()
+    d = len(first["embedding"]) // 4
+    # a new file per build: readers keep the file their snapshot names
+    fd, path = tempfile.mkstemp(dir=EMB_PATH.parent, prefix=EMB_PATH.stem + ".",
+                                suffix=EMB_PATH.suffix)
+    os.close(fd)
+    path = Path(path)
+    out = np.lib.format.open_memmap(path, mode="w+", dtype="<f4", shape=(n, d))
+    index = []
+    try:
+        for i, r in enumerate(c.execute(_SQL_SCAN_EMBEDDINGS)):
+            if len(r["embedding"]) != 4 * d:
+                raise ValueError(f"embedding of {r['filename']!r} has "
+                                 f"{len(r['embedding']) // 4} dims, expected {d}")
+            out[i] = np.frombuffer(r["embedding"], dtype="<f4")   # fill in place
+            index.append((r["filename"], i))
+        out.flush()
+        del out
+
+        c.execute("DELETE FROM embedding_shard")
+        c.executemany(_SQL_INSERT_SHARD, index)
+        c.execute(_SQL_SET_SHARD_FILE, (path.name,))
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    return path
+
+
+def _rebuild_shard() -> None:
+    """Build a new shard unless another process just did; drop the old file."""
+    path = None
+    try:
+        # BEGIN IMMEDIATE serialises builders across processes; re-check
+        # once we hold the lock, another dr.py may have just built it
+        with conn(write=True) as c:
+            if _shard_covers(c):
+                return
+            old = c.execute(_SQL_SHARD_FILE).fetchone()
+            path = _build_shard(c)
+    except BaseException:
+        if path is not None:        # built, but the commit failed
+            path.unlink(missing_ok=True)
+        raise
+    # only after the commit; readers holding the old snapshot retry on
+    # FileNotFoundError, processes that mapped it keep their mapping.
+    # Without a shard_file row the old shard is EMB_PATH itself.
+    (EMB_PATH.parent / old["name"] if old else EMB_PATH).unlink(missing_ok=True)
+
+
+# ---------------------------------------------------------------------
+# 4)  convenience helpers
 # ---------------------------------------------------------------------
 def fetch_subset(strategy: str, size: int, rng_state: int | None = None):
     """
     Returns (embeddings : np.ndarray, meta_rows : list[dict])
-    * strategy == "artist_first5" | "random"
-    * size     == max #rows (enforced in SQL LIMIT)
+    * strategy  == "artist_first5" | "random"
+    * size      == max #rows
+    * rng_state seeds the "random" sampler (same seed → same subset)
     """
-    import numpy as np
+    if strategy not in ("artist_first5", "random"):
+        raise ValueError(f"Unknown subset strategy: {strategy}")
 
-    with conn() as c:
-        if strategy == "artist_first5":
-            rows = c.execute("""
-              WITH ranked AS (
-                SELECT filename, artist, embedding,
-                       ROW_NUMBER() OVER (PARTITION BY artist ORDER BY filename) rn
-                  FROM embeddings
-              )
-              SELECT * FROM ranked WHERE rn <= 5 LIMIT ?;
-            """, (size,)).fetchall()
-
-        elif strategy == "random":
-            if rng_state is not None:
-                c.execute("SELECT random(?)", (rng_state,))
-            rows = c.execute(
-                "SELECT * FROM embeddings ORDER BY random() LIMIT ?", (size,)
-            ).fetchall()
-
-        else:
-            raise ValueError(f"Unknown subset strategy: {strategy}")
-
-    embeds = np.vstack([np.frombuffer(r["embedding"], dtype=np.float32) for r in rows])
-    meta   = [dict(r) for r in rows]
+    for _ in range(3):
+        with conn() as c:
+            if strategy == "artist_first5":
+                rows = c.execute(_SQL_ARTIST_FIRST5, (size,)).fetchall()
+            else:
+                rowids = [r[0] for r in c.execute(_SQL_ROWIDS)]
+                pick = random.Random(rng_state).sample(rowids, min(size, len(rowids)))
+                rows = c.execute(
+                    _SQL_ROWS_BY_ID.format(",".join("?" * len(pick))), pick
+                ).fetchall()
+
+            # one batched lookup of the shard rows for the chosen filenames;
+            # shard file and row map come from the same snapshot as the rows
+            fns = [r["filename"] for r in rows]
+            shard = _open_shard(c) if fns else None
+            row_of = dict(c.execute(
+                _SQL_SHARD_ROWS.format(",".join("?" * len(fns))), fns
+            ).fetchall())
+        if not fns:
+            import numpy as np
+            return np.empty((0, 0), dtype=np.float32), []
+        if shard is not None and len(row_of) == len(fns):
+            break
+        # no shard yet, or embeddings changed since it was built
+        _rebuild_shard()
+    else:
+        raise RuntimeError("embeddings kept changing while the shard was rebuilt")
+
+    # fancy indexing copies just the selected rows out of the memmap
+    embeds = shard[[row_of[fn] for fn in fns]]
+    meta   = list(map(dict, rows))
     return embeds, meta
 
 
+def params_json(params: dict[str, Any]) -> str:
+    """
+    Canonical params JSON (sorted keys, compact) as stored in configs and
+    hashed into cache keys.  Always the stdlib encoder: orjson spells
+    floats differently (1e-7 vs 1e-07, NaN as null), so the text would
+    depend on whether it is installed.
+    """
+    return json.dumps(params, sort_keys=True, separators=(",", ":"),
+                      ensure_ascii=False)
+
+
+def find_config(cache_key: str) -> int | None:
+    """Return the config_id previously stored under `cache_key`, if any."""
+    with conn() as c:
+        row = c.execute(_SQL_FIND_CONFIG, (cache_key,)).fetchone()
+    return row["config_id"] if row else None
+
+
+def _upsert_config(c: sqlite3.Connection, method: str, subset_strategy: str,
+                   subset_size: int, params: dict[str, Any], runtime: float,
+                   config_id: int | None, cache_key: str | None) -> int:
+    params_js = params_json(params)
+
+    if cache_key is not None:
+        if config_id is None:
+            row = c.execute(_SQL_FIND_CONFIG, (cache_key,)).fetchone()
+            if row is not None:
+                return row["config_id"]
+        # a row holding the key without points, or the row being overwritten
+        c.execute(_SQL_RELEASE_CACHE_KEY, (cache_key, config_id))
+    if config_id is None:
+        cur = c.execute(
+            _SQL_INSERT_CONFIG,
+            (method, subset_strategy, subset_size, params_js, runtime,
+             cache_key)
+        )
+        return cur.lastrowid
+    else:
+        c.execute(
+            _SQL_REPLACE_CONFIG,
+            (config_id, method, subset_strategy, subset_size,
+             params_js, runtime, cache_key)
+        )
+        return config_id
+
+
+def _pack_points(filenames: Sequence[str], artists: Sequence[str],
+                 xy: Any) -> tuple[bytes, bytes, bytes]:
+    """Validate one run's points and encode them as point_coords BLOBs."""
+    import numpy as np
+
+    xy = np.ascontiguousarray(xy, dtype="<f4")
+    if xy.shape != (len(filenames), 2) or len(artists) != len(filenames):
+        raise ValueError(f"expected {len(filenames)} points of (x, y), got xy{xy.shape} "
+                         f"and {len(artists)} artists")
+    bad = next((s for s in (*filenames, *artists) if "\n" in s), None)
+    if bad is not None:
+        raise ValueError(f"name {bad!r} contains a newline, the point_coords separator")
+    return (xy.tobytes(), "\n".join(filenames).encode(),
+            "\n".join(artists).encode())
+
+
 def upsert_config(method: str, subset_strategy: str, subset_size: int,
                   params: dict[str, Any], runtime: float,
-                  config_id: int | None = None) -> int:
+                  config_id: int | None = None,
+                  cache_key: str | None = None) -> int:
     """
     Inserts a new config row OR overwrites an existing one if `config_id` supplied.
+    `cache_key` (see find_config) is unique: an insert whose key already has
+    a stored run returns that row's id instead, otherwise the key is taken
+    from whichever row held it rather than evicting that row.
     Returns the row's (possibly newly-generated) id.
     """
-    params_json = json.dumps(params, sort_keys=True)
+    with conn(write=True) as c:
+        return _upsert_config(c, method, subset_strategy, subset_size, params,
+                              runtime, config_id, cache_key)
 
-    with conn() as c:
-        if config_id is None:
-            cur = c.execute(
-                """INSERT INTO configs
-                   (method, subset_strategy, subset_size, params_json, runtime)
-                   VALUES (?,?,?,?,?)""",
-                (method, subset_strategy, subset_size, params_json, runtime)
-            )
-            return cur.lastrowid
-        else:
-            c.execute(
-                """REPLACE INTO configs
-                   (config_id, method, subset_strategy, subset_size,
-                    params_json, runtime)
-                   VALUES (?,?,?,?,?,?)""",
-                (config_id, method, subset_strategy, subset_size,
-                 params_json, runtime)
-            )
-            return config_id
-
-
-def save_points(config_id: int, points: Iterable[tuple[str, str, float, float]]):
+
+def save_points(config_id: int, filenames: Sequence[str], artists: Sequence[str],
+                xy: Any):
     """
-    Bulk-insert projected points:
-        points iterable of (filename, artist, x, y)
+    Store all projected points of a config as one point_coords row:
+        filenames, artists  N strings each, stored newline-joined
+        xy                  (N, 2) array-like of x/y, stored as float32
     """
-    with conn() as c:
-        c.executemany("""
-          INSERT INTO projection_points(filename, artist, config_id, x, y)
-               VALUES (?,?,?, ?,?)
-        """, [(fn, ar, config_id, float(x), float(y)) for fn, ar, x, y in points])
+    blobs = _pack_points(filenames, artists, xy)
+    with conn(write=True) as c:
+        c.execute(_SQL_SAVE_COORDS, (config_id, *blobs))
+
+
+def save_run(method: str, subset_strategy: str, subset_size: int,
+             params: dict[str, Any], runtime: float,
+             filenames: Sequence[str], artists: Sequence[str], xy: Any,
+             config_id: int | None = None,
+             cache_key: str | None = None) -> int:
+    """
+    upsert_config + save_points in one transaction, so a cache_key is never
+    committed without its points; the points are validated before either
+    write.  Returns the config_id the points were stored under.
+    """
+    blobs = _pack_points(filenames, artists, xy)
+    with conn(write=True) as c:
+        cid = _upsert_config(c, method, subset_strategy, subset_size, params,
+                             runtime, config_id, cache_key)
+        c.execute(_SQL_SAVE_COORDS, (cid, *blobs))
+    return cid
 
 
 def load_config_blob(config_id: int) -> dict[str, Any]:
-    """Return {config: row-dict, points: [row-dict,…]} for JSON passthrough."""
+    """
+    Return {config: row-dict, points: {filename, artist, x, y}} for JSON
+    passthrough; points are columnar (one list per field, same order).
+    """
     with conn() as c:
-        cfg = c.execute("SELECT * FROM configs WHERE config_id = ?", (config_id,)).fetchone()
+        cfg = c.execute(_SQL_SELECT_CONFIG, (config_id,)).fetchone()
         if cfg is None:
             raise KeyError(f"config_id {config_id} not found")
 
-        pts = c.execute("""
-            SELECT filename, artist, config_id, x, y
-              FROM projection_points
-             WHERE config_id = ?
-        """, (config_id,)).fetchall()
+        soa = c.execute(_SQL_SELECT_COORDS, (config_id,)).fetchone()
+        pts = (None if soa is not None else
+               c.execute(_SQL_SELECT_LEGACY_POINTS, (config_id,)).fetchall())
+
+    if soa is not None:
+        import numpy as np
 
+        xy   = np.frombuffer(soa["xy"], dtype="<f4").reshape(-1, 2)
+        fns  = soa["filenames"].decode().split("\n") if len(xy) else []
+        arts = soa["artists"].decode().split("\n") if len(xy) else []
+        xs, ys = xy[:, 0].tolist(), xy[:, 1].tolist()
+    else:
+        fns, arts, xs, ys = zip(*pts) if pts else ((), (), (), ())
     return {
         "config": dict(cfg),
-        "points": [dict(r) for r in pts]
+        "points": {"filename": list(fns), "artist": list(arts),
+                   "x": list(xs), "y": list(ys)}
     }
@@ -7,10 +7,14 @@ dr.py – All-in-one DR runner + dynamic metadata generator.
 • Uses Python 3.13 argparse with mutually exclusive flags.
 """
 
-import argparse, json, sys, time, warnings
+import argparse, functools, hashlib, importlib, json, sys, threading, time, warnings
 from typing import Any
-import numpy as np           # numeric core
-import db                     # our db.py layer
+try:
+    import orjson             # optional: fast C encoder, numpy-aware
+except ImportError:
+    orjson = None
+# numpy, db (SQLite bootstrap) and cuml.accel are imported after the
+# --list-* flags are handled (section 4), so listings stay lightweight.
 
 # Configure warnings to go to stderr instead of stdout
 warnings.filterwarnings("ignore", category=FutureWarning, module="sklearn")
@@ -24,7 +28,11 @@ def print_to_stderr(*args, **kwargs):
 
 # We'll use this function for JSON output to ensure it goes to stdout
 def print_json(data):
-    original_print(json.dumps(data), file=sys.stdout)
+    if orjson is not None:
+        out = orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    else:
+        out = json.dumps(data)
+    original_print(out, file=sys.stdout)
     sys.stdout.flush()
 
 # Replace the built-in print with our stderr version for normal messages
@@ -40,9 +48,8 @@ def umap(X, **cfg):
         if "n_components" not in cfg:
             cfg["n_components"] = 2
             
-        # Handle deprecated parameters
-        cfg = _handle_deprecated_params(cfg)
-            
+        # UMAP computes in float32/C-order; match it so check_array doesn't copy
+        X = np.ascontiguousarray(X, dtype=np.float32)
         return umap.UMAP(**cfg).fit_transform(X)
     except ImportError:
         raise ImportError("UMAP package is not installed. Please install it with: pip install umap-learn")
@@ -54,9 +61,6 @@ def tsne(X, **cfg):
         if "n_components" not in cfg:
             cfg["n_components"] = 2
             
-        # Handle deprecated parameters
-        cfg = _handle_deprecated_params(cfg)
-            
         return TSNE(**cfg).fit(X)
     except ImportError:
         # Fallback to sklearn's TSNE if openTSNE is not available
@@ -66,9 +70,6 @@ def tsne(X, **cfg):
             if "n_components" not in cfg:
                 cfg["n_components"] = 2
                 
-            # Handle deprecated parameters
-            cfg = _handle_deprecated_params(cfg)
-                
             return SklearnTSNE(**cfg).fit_transform(X)
         except ImportError:
             raise ImportError("Neither openTSNE nor sklearn's TSNE are installed. Please install one of them.")
@@ -99,11 +100,17 @@ def phate(X, **cfg):
             return umap(X, **umap_cfg)
         except Exception as e:
             raise ImportError(f"PHATE package is not installed and fallback to UMAP failed: {str(e)}. Please install PHATE with: pip install phate")
+# PCA pre-step shared by pacmap/trimap. Randomized SVD suits d=512 → k≤100.
+def _pca(X, k):
+    """Return X projected onto its first k (≤ N, d) principal components."""
+    from sklearn.decomposition import PCA
+    pca = PCA(n_components=min(k, *X.shape), svd_solver="randomized", random_state=0)
+    return pca.fit_transform(X.astype(np.float32, copy=False))
+
 def pacmap(X, **cfg):
     try:
         import pacmap
-        from sklearn.decomposition import PCA
-        Xp = PCA(n_components=min(25, X.shape[1])).fit_transform(X.astype(np.float32))
+        Xp = _pca(X, 25)
         
         # Set default values for parameters if not provided
         defaults = {
@@ -174,6 +181,10 @@ def trimap(X, **cfg):
         # Ensure n_components has a default value if not provided
         if "n_components" not in cfg:
             cfg["n_components"] = 2
+        # TriMAP's apply_pca reduces d > 100 to 100 dims; do it via the shared PCA
+        if cfg.get("apply_pca", True) and X.shape[1] > 100:
+            X = _pca(X, 100)
+            cfg["apply_pca"] = False
         return trimap.TRIMAP(**cfg).fit_transform(X)
     except ImportError:
         # Fallback to UMAP if trimap is not available
@@ -292,7 +303,7 @@ def glle(X, **cfg):
 
 def clmds(X, **cfg):
     try:
-        from scipy.spatial.distance import pdist, squareform
+        from sklearn.metrics import pairwise_distances
         from cluster_mds import clMDS
         
         # Set default values for parameters if not provided
@@ -307,8 +318,8 @@ def clmds(X, **cfg):
             if key not in cfg:
                 cfg[key] = value
         
-        # Calculate distance matrix
-        D = squareform(pdist(X, metric="euclidean"))
+        # Calculate distance matrix (BLAS GEMM in float32, no squareform copy)
+        D = pairwise_distances(X.astype(np.float32, copy=False), metric="euclidean")
         
         # Initialize clMDS with verbose parameter
         m = clMDS(D, verbose=cfg["verbose"])
@@ -344,6 +355,19 @@ ALGOS = {
     "clmds": clmds
 }
 
+# first heavy import each wrapper performs; pre-imported during SQLite I/O
+ALGO_MODULES = {
+    "umap": "umap",
+    "tsne": "openTSNE",
+    "phate": "phate",
+    "pacmap": "pacmap",
+    "spacemap": "spacemap",
+    "trimap": "trimap",
+    "tsnepso": "tsne_pso",
+    "glle": "GLLE.functions.my_GLLE",
+    "clmds": "cluster_mds"
+}
+
 # ───────────────────────────────────────────────────────────────
 # 2) Dynamic metadata (single source of truth)
 # ───────────────────────────────────────────────────────────────
@@ -470,6 +494,21 @@ if args.list_params:
     print_json(defs)
     sys.exit(0)
 
+# heavy imports, only needed for an actual DR run
+import numpy as np           # numeric core
+import db                     # our db.py layer
+
+# If RAPIDS cuML is installed, route umap.UMAP / sklearn estimators (TSNE,
+# PCA, …) to the GPU; it falls back to CPU for anything unsupported.
+# Must run before the wrappers above import umap/sklearn.
+try:
+    import cuml.accel
+    cuml.accel.install()
+except ImportError:
+    pass
+except Exception as e:   # installed, but no usable GPU/driver
+    print(f"Warning: cuml.accel unavailable ({e}), running on CPU")
+
 # ───────────────────────────────────────────────────────────────
 # 5) Main DR flow
 # ───────────────────────────────────────────────────────────────
@@ -498,43 +537,76 @@ def _parse_kv(pairs: list[str]) -> dict[str, Any]:
                 out[k] = v
     return out
 
-# Handle deprecated parameters
-def _handle_deprecated_params(cfg: dict) -> dict:
-    """Update deprecated parameters to their new names"""
-    # Create a copy to avoid modifying the original
-    updated_cfg = cfg.copy()
-    
-    # Handle force_all_finite -> ensure_all_finite
-    if "force_all_finite" in updated_cfg and "ensure_all_finite" not in updated_cfg:
-        updated_cfg["ensure_all_finite"] = updated_cfg.pop("force_all_finite")
-    
-    # Handle n_iter -> max_iter (for t-SNE)
-    if "n_iter" in updated_cfg and "max_iter" not in updated_cfg:
-        updated_cfg["max_iter"] = updated_cfg.pop("n_iter")
-    
-    return updated_cfg
+# Deprecated keyword → current name, resolved once per method at import.
+# force_all_finite is an sklearn-wide rename; n_iter → max_iter only
+# concerns sklearn's TSNE (tsnepso's own schema still uses n_iter).
+_COMMON_RENAMES = {"force_all_finite": "ensure_all_finite"}
+_METHOD_RENAMES = {"tsne": {"n_iter": "max_iter"}}
+
+def _remap(cfg: dict, rename: dict[str, str]) -> dict:
+    """Return a copy of cfg with deprecated keys renamed (unless the new key is set)."""
+    return {(rename[k] if k in rename and rename[k] not in cfg else k): v
+            for k, v in cfg.items()}
+
+_ALGO_ARGS = {
+    m: functools.partial(_remap, rename={**_COMMON_RENAMES, **_METHOD_RENAMES.get(m, {})})
+    for m in ALGOS
+}
+
+def _cache_key(method: str, cfg: dict, meta: list[dict]) -> str:
+    """Hash of (method, canonical params, sorted subset filenames)."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(method.encode())
+    h.update(b"\0" + db.params_json(cfg).encode())
+    for fn in sorted(m["filename"] for m in meta):
+        h.update(b"\0" + fn.encode())
+    return h.hexdigest()
 
 cfg = _parse_kv(args.param)
 
 # Handle deprecated parameters
-cfg = _handle_deprecated_params(cfg)
+cfg = _ALGO_ARGS[args.method](cfg)
 
 # clamp subset size
 size = max(1, min(500, args.subset_size))
 
+# import the algorithm's package on a daemon thread while the subset is
+# fetched; only a cache miss waits for it, a hit exits without it
+def _preimport(name: str) -> None:
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        pass  # the wrapper reports this and falls back
+
+preload = None
+if args.method in ALGO_MODULES:
+    preload = threading.Thread(target=_preimport, args=(ALGO_MODULES[args.method],),
+                               daemon=True)
+    preload.start()
+
 # fetch high-dim embeddings + metadata
 X, meta = db.fetch_subset(args.subset_strategy, size,
                           rng_state=cfg.get("random_state"))
 
-# run the chosen algorithm
-t0 = time.time()
-Y = ALGOS[args.method](X, **cfg)
-runtime = time.time() - t0
-
-# upsert config & save projected points
-cid = db.upsert_config(args.method, args.subset_strategy, size, cfg, runtime,
-                       config_id=args.config_id)
-db.save_points(cid, [(m["filename"], m["artist"], x, y) for m,(x,y) in zip(meta,Y)])
+# content-addressed cache: identical method + params + subset → reuse the
+# stored run instead of recomputing (skipped when overwriting a config_id)
+key = _cache_key(args.method, cfg, meta)
+cid = db.find_config(key) if args.config_id is None else None
+
+if cid is None:
+    if preload is not None:
+        preload.join()
+    # run the chosen algorithm
+    t0 = time.time()
+    Y = ALGOS[args.method](X, **cfg)
+    runtime = time.time() - t0
+
+    # upsert config & save projected points in one transaction; if an
+    # identical run stored the same key meanwhile, its id comes back and
+    # these points replace its own
+    cid = db.save_run(args.method, args.subset_strategy, size, cfg, runtime,
+                      [m["filename"] for m in meta], [m["artist"] for m in meta], Y,
+                      config_id=args.config_id, cache_key=key)
 
 # emit full JSON blob for server
 result = db.load_config_blob(cid)
@@ -1217,7 +1217,11 @@
       return showStatus("DR failed", true);
     }
 
-    const { config, points } = await resp.json();
+    const { config, points: cols } = await resp.json();
+    // points arrive columnar ({filename[], artist[], x[], y[]}); rehydrate
+    const points = cols.filename.map((filename, i) => ({
+      filename, artist: cols.artist[i], x: cols.x[i], y: cols.y[i],
+    }));
     metaPre.textContent = JSON.stringify(config, null, 2);
     showStatus(`✔️ #${config.config_id}: ${points.length} pts in ${config.runtime.toFixed(2)} s`);
 
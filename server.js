@@ -184,6 +184,24 @@ Bun.serve({
       const id = Number(searchParams.get("config_id"));
       if (!id) return new Response("Missing config_id", { status: 400 });
       const method = searchParams.get("method") || "umap";
+      const soa = DB.query(
+        `SELECT c.xy, c.filenames, c.artists
+           FROM point_coords AS c
+           JOIN configs USING(config_id)
+          WHERE method = ? AND config_id = ?`
+      ).get(method, id);
+      if (soa) {
+        // one row per config: float32 (x, y) pairs + newline-joined names
+        const xy = new Float32Array(new Uint8Array(soa.xy).buffer);
+        const n = xy.length / 2;
+        const dec = new TextDecoder();
+        const files = n ? dec.decode(soa.filenames).split("\n") : [];
+        const artists = n ? dec.decode(soa.artists).split("\n") : [];
+        return Response.json(files.map((filename, i) => (
+          { filename, artist: artists[i], x: xy[2 * i], y: xy[2 * i + 1] }
+        )));
+      }
+      // configs saved before point_coords existed
       const pts = DB.query(
         `SELECT p.filename, p.artist, p.x, p.y
            FROM projection_points AS p